@@ -0,0 +1,173 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException, Request
+
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "2"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "16"))
+ADMISSION_PER_USER = int(os.getenv("ADMISSION_PER_USER", "4"))
+# Anonymous callers are keyed by client IP, which is only the real client when uvicorn trusts the
+# proxy's X-Forwarded-For (FORWARDED_ALLOW_IPS); otherwise every caller shares the proxy's IP.
+ADMISSION_PER_IP = int(os.getenv("ADMISSION_PER_IP", "4"))
+# Kept below the 30s client timeout used by stress_test.py, so we give up before the client does.
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "25"))
+DISCONNECT_POLL_SECONDS = 0.25
+
+HIGH, LOW = 0, 1
+
+
+class AdmissionController:
+    # Runs on the event loop only, so the counters need no locking.
+    def __init__(self, max_concurrency: int = ADMISSION_MAX_CONCURRENCY, max_queue: int = ADMISSION_MAX_QUEUE,
+                 per_user: int = ADMISSION_PER_USER, per_ip: int = ADMISSION_PER_IP,
+                 max_wait: float = ADMISSION_MAX_WAIT):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.per_user = per_user
+        self.per_ip = per_ip
+        self.max_wait = max_wait
+        self._active = 0
+        self._queues = (deque(), deque())
+        self._per_user = {}
+        self._avg_seconds = 1.0
+        self._counts = {"admitted": 0, "rejected": 0, "evicted": 0, "expired": 0, "disconnected": 0}
+
+    def _queued(self) -> int:
+        return len(self._queues[HIGH]) + len(self._queues[LOW])
+
+    def _retry_after(self) -> str:
+        return str(max(1, math.ceil((self._queued() + 1) * self._avg_seconds / self.max_concurrency)))
+
+    def _deadline(self, request: Request) -> float:
+        # Clients may propagate their own deadline; we never wait longer than max_wait.
+        try:
+            timeout = float(request.headers.get("X-Request-Timeout", self.max_wait))
+        except ValueError:
+            timeout = self.max_wait
+        if not (math.isfinite(timeout) and timeout > 0):
+            timeout = self.max_wait
+        return time.monotonic() + min(timeout, self.max_wait)
+
+    def _release_slot(self):
+        # Hand the slot straight to the next waiter, authenticated callers first.
+        for queue in self._queues:
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self._active -= 1
+
+    def _limit(self, priority: int) -> int:
+        # Authenticated callers are keyed by user id, anonymous ones by IP.
+        return self.per_user if priority == HIGH else self.per_ip
+
+    def _user_done(self, user_key: str):
+        self._per_user[user_key] -= 1
+        if not self._per_user[user_key]:
+            del self._per_user[user_key]
+
+    async def _wait_for_slot(self, request: Request, priority: int, deadline: float):
+        waiter = asyncio.get_running_loop().create_future()
+        queue = self._queues[priority]
+        queue.append(waiter)
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counts["expired"] += 1
+                    raise HTTPException(status_code=503, detail="Timed out waiting for capacity",
+                                        headers={"Retry-After": self._retry_after()})
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), timeout=min(DISCONNECT_POLL_SECONDS, remaining))
+                    return
+                except asyncio.TimeoutError:
+                    pass
+                if await request.is_disconnected():
+                    self._counts["disconnected"] += 1
+                    raise HTTPException(status_code=499, detail="Client disconnected")
+        except BaseException:
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                # We were handed a slot but are leaving; pass it on.
+                self._release_slot()
+            elif not waiter.done():
+                waiter.cancel()
+                queue.remove(waiter)
+            raise
+
+    def _evict_anonymous(self) -> bool:
+        # Makes room for an authenticated caller by rejecting the newest anonymous waiter.
+        queue = self._queues[LOW]
+        while queue:
+            waiter = queue.pop()
+            if not waiter.done():
+                self._counts["evicted"] += 1
+                waiter.set_exception(HTTPException(status_code=429, detail="Server busy, try again later",
+                                                   headers={"Retry-After": self._retry_after()}))
+                return True
+        return False
+
+    def _reject(self, detail: str) -> HTTPException:
+        self._counts["rejected"] += 1
+        return HTTPException(status_code=429, detail=detail, headers={"Retry-After": self._retry_after()})
+
+    def check(self, user_key: str, priority: int):
+        # Cheap pre-check so callers can refuse before doing per-request work such as hashing.
+        # acquire() checks again, since the state may change in between.
+        if self._per_user.get(user_key, 0) >= self._limit(priority):
+            raise self._reject("Too many concurrent requests")
+        if self._queued() >= self.max_queue and not (priority == HIGH and any(not w.done() for w in self._queues[LOW])):
+            raise self._reject("Server busy, try again later")
+
+    async def acquire(self, request: Request, user_key: str, priority: int):
+        if self._per_user.get(user_key, 0) >= self._limit(priority):
+            raise self._reject("Too many concurrent requests")
+        self._per_user[user_key] = self._per_user.get(user_key, 0) + 1
+        try:
+            if self._active < self.max_concurrency and not self._queued():
+                self._active += 1
+            elif self._queued() >= self.max_queue and not (priority == HIGH and self._evict_anonymous()):
+                raise self._reject("Server busy, try again later")
+            else:
+                await self._wait_for_slot(request, priority, self._deadline(request))
+        except BaseException:
+            self._user_done(user_key)
+            raise
+        self._counts["admitted"] += 1
+
+    def try_acquire(self) -> bool:
+        # Takes a free slot without queueing, for optional work such as shadow scoring.
+        if self._active < self.max_concurrency and not self._queued():
+            self._active += 1
+            return True
+        return False
+
+    def release(self):
+        self._release_slot()
+
+    @asynccontextmanager
+    async def slot(self, request: Request, user_key: str, priority: int = LOW):
+        await self.acquire(request, user_key, priority)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * (time.monotonic() - start)
+            self._release_slot()
+            self._user_done(user_key)
+
+    def stats(self):
+        return {
+            "active": self._active,
+            "queued_authenticated": len(self._queues[HIGH]),
+            "queued_anonymous": len(self._queues[LOW]),
+            "avg_seconds": round(self._avg_seconds, 3),
+            **self._counts,
+        }
+
+
+controller = AdmissionController()
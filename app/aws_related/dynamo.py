@@ -165,7 +165,8 @@ def _query_user_by_username(username: str):
 
 # --- Images -------------------------------------------------------------------
 
-def images_insert(filename: str, s3_key: str, user_id: str, prediction: str, confidence):
+def images_insert(filename: str, s3_key: str, user_id: str, prediction: str, confidence,
+                  phash: str | None = None, duplicate_of: str | None = None, model_version: str | None = None):
     t = _tbl(IMAGES_TABLE)
     image_id = str(uuid.uuid4())
     # DynamoDB wants Decimal, not float
@@ -179,6 +180,9 @@ def images_insert(filename: str, s3_key: str, user_id: str, prediction: str, con
         "prediction": prediction,
         "confidence": conf_attr,
         "user_prediction": None,
+        "phash": phash,
+        "duplicate_of": duplicate_of,
+        "model_version": model_version,
         "uploaded_at": _now_iso(),
     }
     # Remove None attributes (DynamoDB rejects empty values)
@@ -208,6 +212,17 @@ def images_update_s3_key(image_id: str, s3_key: str):
     )
     return {"updated": "Attributes" in res}
 
+def images_update_preview_keys(image_id: str, thumbnail_key: str, medium_key: str):
+    t = _tbl(IMAGES_TABLE)
+    res = t.update_item(
+        Key=_key(image_id),
+        UpdateExpression="SET thumbnail_key = :t, medium_key = :m",
+        ExpressionAttributeValues={":t": thumbnail_key, ":m": medium_key},
+        ConditionExpression="attribute_exists(id)",
+        ReturnValues="UPDATED_NEW",
+    )
+    return {"updated": "Attributes" in res}
+
 def images_get_by_id(image_id: str):
     t = _tbl(IMAGES_TABLE)
     res = t.get_item(Key=_key(image_id))
@@ -246,6 +261,62 @@ def images_list(limit: int, offset: int, sort_by: str, order: str, username: str
     start, end = offset or 0, (offset or 0) + (limit or 10)
     return items[start:end]
 
+def images_iter(username: str | None = None, prediction: str | None = None, page_size: int = 200,
+                changed_since: str | None = None):
+    # Yields every matching image record one page at a time, without holding the whole table in memory.
+    t = _tbl(IMAGES_TABLE)
+    filters = []
+    if username:
+        u = _query_user_by_username(username)
+        if not u:
+            return
+        filters.append(Attr("user_id").eq(u["id"]))
+    if prediction:
+        filters.append(Attr("prediction").eq(prediction))
+    if changed_since:
+        filters.append(Attr("uploaded_at").gt(changed_since) | Attr("rescored_at").gt(changed_since))
+    start_key = None
+    while True:
+        kwargs = {
+            "KeyConditionExpression": Key(PK_NAME).eq(QUT_USERNAME),
+            "Limit": page_size,
+        }
+        if filters:
+            expr = filters[0]
+            for f in filters[1:]:
+                expr = expr & f
+            kwargs["FilterExpression"] = expr
+        if start_key:
+            kwargs["ExclusiveStartKey"] = start_key
+        res = t.query(**kwargs)
+        yield from res.get("Items", [])
+        start_key = res.get("LastEvaluatedKey")
+        if not start_key:
+            break
+        time.sleep(0.02)
+
+def images_update_prediction(image_id: str, prediction: str, confidence, model_version: str | None, rescored_at: str):
+    # Only touches the scoring fields, so feedback and preview keys written meanwhile survive,
+    # and the condition keeps deleted images from being re-created.
+    t = _tbl(IMAGES_TABLE)
+    try:
+        t.update_item(
+            Key=_key(image_id),
+            UpdateExpression="SET prediction = :p, confidence = :c, model_version = :v, rescored_at = :r",
+            ExpressionAttributeValues={
+                ":p": prediction,
+                ":c": Decimal(str(confidence)),
+                ":v": model_version,
+                ":r": rescored_at,
+            },
+            ConditionExpression="attribute_exists(id)",
+        )
+        return {"updated": True}
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return {"updated": False}
+        raise
+
 def images_delete(image_id: str):
     t = _tbl(IMAGES_TABLE)
     try:
@@ -278,8 +349,11 @@ __all__ = [
     "images_insert",
     "images_update_user_prediction",
     "images_update_s3_key",
+    "images_update_preview_keys",
     "images_get_by_id",
     "images_list",
+    "images_iter",
+    "images_update_prediction",
     "images_delete",
     "put_accuracy",
 ]
\ No newline at end of file
@@ -1,6 +1,9 @@
 import os
 import re
 import io
+import fcntl
+import glob
+import shutil
 import boto3
 from botocore.exceptions import ClientError
 import torch
@@ -8,6 +11,8 @@ import torch
 AWS_REGION = os.getenv("AWS_REGION", "ap-southeast-2")
 S3_BUCKET = os.getenv("AWS_S3_BUCKET", "")
 MODEL_KEY = os.getenv("AWS_S3_MODEL_KEY", "model/model.pth")
+# When set, weights are cached here and memory-mapped so every worker on the host shares one copy.
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", "")
 
 _session = boto3.session.Session(region_name=AWS_REGION)
 _s3 = _session.client("s3")
@@ -20,6 +25,20 @@ def put_image_to_s3(filename: str, image_id: str, data: bytes) -> str:
     _s3.put_object(Bucket=S3_BUCKET, Key=key, Body=data, ContentType="image/jpeg")
     return key
 
+def put_preview_to_s3(image_id: str, size_name: str, data: bytes) -> str:
+    key = f"uploads/{image_id}/{size_name}.jpg"
+    _s3.put_object(Bucket=S3_BUCKET, Key=key, Body=data, ContentType="image/jpeg")
+    return key
+
+def get_object_bytes(key: str) -> bytes:
+    return _s3.get_object(Bucket=S3_BUCKET, Key=key)["Body"].read()
+
+def iter_keys(prefix: str):
+    paginator = _s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            yield obj["Key"]
+
 def get_image_from_s3_presigned_url(key: str, expires: int = 3600) -> str | None:
     if not key:
         return None
@@ -29,16 +48,73 @@ def get_image_from_s3_presigned_url(key: str, expires: int = 3600) -> str | None
         return None
 
 def delete_image_from_s3(filename: str, image_id: str):
-    key = f"uploads/{image_id}/{_safe_filename(filename)}"
-    try:
-        _s3.delete_object(Bucket=S3_BUCKET, Key=key)
-    except ClientError:
-        pass
+    keys = [f"uploads/{image_id}/{_safe_filename(filename)}"]
+    keys += [f"uploads/{image_id}/{size_name}.jpg" for size_name in ("thumbnail", "medium")]
+    for key in keys:
+        try:
+            _s3.delete_object(Bucket=S3_BUCKET, Key=key)
+        except ClientError:
+            pass
+
+def resolve_model(key: str = MODEL_KEY) -> dict:
+    # One HEAD decides the version; load_model then fetches exactly that object, so the
+    # recorded version always matches the weights even if the key is overwritten meanwhile.
+    head = _s3.head_object(Bucket=S3_BUCKET, Key=key)
+    etag = head["ETag"].strip('"')
+    version = head.get("VersionId")
+    if version and version != "null":
+        params = {"VersionId": version}
+    else:
+        version, params = etag, {"IfMatch": head["ETag"]}
+    return {"key": key, "version": f"{key}@{version}", "etag": etag, "params": params}
+
+def get_model_version(key: str = MODEL_KEY) -> str:
+    return resolve_model(key)["version"]
+
+def _get_model_object(ref: dict):
+    return _s3.get_object(Bucket=S3_BUCKET, Key=ref["key"], **ref["params"])["Body"]
+
+def cache_model_file(ref: dict) -> str:
+    os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+    path = os.path.join(MODEL_CACHE_DIR, f"{_safe_filename(ref['key'])}-{ref['etag']}")
+    # Workers start together; the lock makes the first one download and the rest reuse its file.
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            tmp = f"{path}.tmp"
+            with open(tmp, "wb") as f:
+                shutil.copyfileobj(_get_model_object(ref), f)
+            os.replace(tmp, path)
+    return path
+
+def prune_model_cache(key: str, keep: str):
+    # Older versions may still be mapped by workers serving them; unlinking is safe on Linux,
+    # the pages stay valid until those mappings go away. Each file is removed under its own
+    # lock, so a download another worker is running is left alone. Lock files are kept: removing
+    # one while a worker waits on it would let two workers download the same file.
+    pattern = os.path.join(MODEL_CACHE_DIR, f"{glob.escape(_safe_filename(key))}-*")
+    for path in glob.glob(pattern):
+        if path == keep or path.endswith((".tmp", ".lock")):
+            continue
+        with open(f"{path}.lock", "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
-def load_model():
+def load_model(ref: dict):
+    # ref comes from resolve_model().
+    if MODEL_CACHE_DIR:
+        path = cache_model_file(ref)
+        state = torch.load(path, map_location="cpu", mmap=True)
+        prune_model_cache(ref["key"], keep=path)
+        return state
     buf = io.BytesIO()
-    obj = _s3.get_object(Bucket=S3_BUCKET, Key=MODEL_KEY)
-    buf.write(obj["Body"].read())
+    buf.write(_get_model_object(ref).read())
     buf.seek(0)
     state = torch.load(buf, map_location="cpu")
-    return state
\ No newline at end of file
+    return state
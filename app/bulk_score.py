@@ -0,0 +1,172 @@
+import argparse
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import boto3
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+
+from app.aws_related import dynamo, s3
+from app.model import AIImageDetector
+from app.utils import image_transform
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+PREVIEW_NAMES = ("thumbnail.jpg", "medium.jpg")
+
+
+class ImageSource(Dataset):
+    # Samples are (sample_id, location) pairs; location is a local path or an S3 key.
+    def __init__(self, samples: list, from_s3: bool):
+        self.samples = samples
+        self.from_s3 = from_s3
+        self._client = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def _read(self, location: str) -> bytes:
+        if not self.from_s3:
+            with open(location, "rb") as f:
+                return f.read()
+        # boto3 clients are not fork-safe, so each DataLoader worker opens its own.
+        if self._client is None:
+            self._client = boto3.session.Session(region_name=s3.AWS_REGION).client("s3")
+        return self._client.get_object(Bucket=s3.S3_BUCKET, Key=location)["Body"].read()
+
+    def __getitem__(self, index):
+        sample_id, location = self.samples[index]
+        try:
+            image = Image.open(io.BytesIO(self._read(location))).convert("RGB")
+            return sample_id, image_transform(image)
+        except Exception as e:
+            print(f"[warn] skipping {location}: {e}")
+            return sample_id, None
+
+
+def collate(batch):
+    ok = [(sample_id, tensor) for sample_id, tensor in batch if tensor is not None]
+    failed = [sample_id for sample_id, tensor in batch if tensor is None]
+    tensors = torch.stack([tensor for _, tensor in ok]) if ok else None
+    return [sample_id for sample_id, _ in ok], tensors, failed
+
+
+def load_checkpoint(path: str) -> set:
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def history_samples(done: set):
+    return [
+        (item["id"], item["s3_key"]) for item in dynamo.images_iter()
+        if item["id"] not in done and item.get("s3_key")
+    ]
+
+
+def directory_samples(directory: str, done: set):
+    samples = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if name.lower().endswith(IMAGE_EXTENSIONS) and path not in done:
+                samples.append((path, path))
+    return samples
+
+
+def s3_samples(prefix: str, done: set):
+    return [
+        (key, key) for key in s3.iter_keys(prefix)
+        if key.lower().endswith(IMAGE_EXTENSIONS) and not key.endswith(PREVIEW_NAMES) and key not in done
+    ]
+
+
+def _update_prediction(row, model_version: str, rescored_at: str):
+    sample_id, label, confidence = row
+    try:
+        dynamo.images_update_prediction(sample_id, label, confidence, model_version, rescored_at)
+    except Exception as e:
+        print(f"[warn] could not update {sample_id}: {e}")
+        return e
+    return None
+
+
+def run(args):
+    done = load_checkpoint(args.checkpoint)
+    if args.history:
+        samples = history_samples(done)
+    elif args.dir:
+        samples = directory_samples(args.dir, done)
+    else:
+        samples = s3_samples(args.s3_prefix, done)
+    print(f"{len(samples)} images to score ({len(done)} already done)")
+
+    detector = AIImageDetector(model_path="image", model_key=args.model_key)
+    loader = DataLoader(
+        ImageSource(samples, from_s3=not args.dir),
+        batch_size=args.batch_size,
+        num_workers=args.workers,
+        collate_fn=collate,
+        persistent_workers=args.workers > 0,
+        prefetch_factor=4 if args.workers > 0 else None,
+    )
+
+    output = open(args.output, "a") if not args.history else None
+    writer = ThreadPoolExecutor(max_workers=args.write_workers) if args.history else None
+    start, scored, failures = time.time(), 0, 0
+    # Failed ids stay out of the checkpoint, so a resumed run retries them (S3 throttling,
+    # network errors); the failures file lists the ones from the latest run.
+    with open(args.checkpoint, "a") as checkpoint, open(args.failures, "w") as failures_file:
+        for sample_ids, tensors, failed in loader:
+            results = detector.predict_batch(tensors) if tensors is not None else []
+            if writer:
+                now = datetime.now(timezone.utc).isoformat()
+                # Per-item conditional updates, in parallel; list() waits so the batch is persisted.
+                rows = [(sample_id, label, confidence) for sample_id, (label, confidence) in zip(sample_ids, results)]
+                errors = list(writer.map(lambda row: _update_prediction(row, detector.version, now), rows))
+                failed = failed + [row[0] for row, error in zip(rows, errors) if error]
+                sample_ids = [row[0] for row, error in zip(rows, errors) if not error]
+            else:
+                for sample_id, (label, confidence) in zip(sample_ids, results):
+                    output.write(json.dumps({
+                        "source": sample_id, "prediction": label, "confidence": confidence, "model_version": detector.version,
+                    }) + "\n")
+                output.flush()
+            # Only mark a batch done once its results are persisted, so a crash just replays it.
+            checkpoint.write("".join(f"{sample_id}\n" for sample_id in sample_ids))
+            checkpoint.flush()
+            failures_file.write("".join(f"{sample_id}\n" for sample_id in failed))
+            failures_file.flush()
+            scored += len(sample_ids)
+            failures += len(failed)
+            print(f"{scored}/{len(samples)} scored, {scored / max(time.time() - start, 1e-9):.1f} images/second")
+    if output:
+        output.close()
+    if writer:
+        writer.shutdown()
+
+    elapsed = time.time() - start
+    print(f"Scored {scored} images in {elapsed:.2f} seconds ({scored / max(elapsed, 1e-9):.1f} images/second)")
+    if failures:
+        print(f"{failures} images failed and are listed in {args.failures}; run again to retry them")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score images in bulk with AIImageDetector.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--history", action="store_true", help="re-score every stored upload and update its record")
+    source.add_argument("--dir", help="score image files under a local directory")
+    source.add_argument("--s3-prefix", help="score images under an S3 prefix")
+    parser.add_argument("--model-key", default=s3.MODEL_KEY, help="S3 key of the model weights to use")
+    parser.add_argument("--output", default="scores.ndjson", help="results file for --dir and --s3-prefix")
+    parser.add_argument("--checkpoint", default="bulk_score.checkpoint", help="file of finished sample ids, used to resume")
+    parser.add_argument("--failures", default="bulk_score.failed", help="file of sample ids that failed in this run")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="parallel decode workers")
+    parser.add_argument("--write-workers", type=int, default=8, help="parallel DynamoDB updates for --history")
+    run(parser.parse_args())
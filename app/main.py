@@ -1,6 +1,7 @@
 # app/main.py
-from io import BytesIO
+from io import BytesIO, StringIO
 import os
+import csv
 import random
 import json
 import urllib.request
@@ -8,18 +9,21 @@ import datetime
 from datetime import timezone
 
 import jwt
-from fastapi import FastAPI, File, UploadFile, HTTPException, Request, Depends, Cookie, Query
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request, Depends, Cookie, Query, BackgroundTasks
 from fastapi.responses import HTMLResponse, FileResponse, RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from fastapi.concurrency import run_in_threadpool
 from urllib.parse import urlparse
 from pydantic import BaseModel
 from PIL import Image
 
 from app.api.controllers import set_user_prediction
 from app.aws_related import dynamo, s3
-from app.utils import preprocess_image
-from app.model import detector
+from app import phash, admission, profiling
+from app.thumbnails import generate_previews
+from app.utils import decode_image, image_transform, memory_usage
+from app.model import manager as model_manager, CascadeDetector, MODEL_KEY
 from app.schemas import DetectionResponse
 
 
@@ -38,6 +42,10 @@ try:
 except Exception as e:
     print(f"[warn] bootstrap failed: {e}")
 
+model_manager.get()
+model_manager.start_polling()
+phash.index.load_in_background()
+
 
 _base_dir = os.path.dirname(os.path.abspath(__file__))
 _candidate_in_app = os.path.join(_base_dir, "public")
@@ -78,6 +86,12 @@ def authenticate_token(authToken: str | None = Cookie(default=None)):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
 
+def admin_auth(user=Depends(browser_auth)):
+    if not dynamo.users_is_admin(user["id"]):
+        raise HTTPException(status_code=403, detail="Unauthorised user requested admin content.")
+    return user
+
+
 @app.post("/login")
 async def login(request: Request):
     data = await request.json()
@@ -108,13 +122,59 @@ async def set_user_feedback(feedback: FeedbackRequest, user=Depends(authenticate
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def run_detection(file_content: bytes):
+    with profiling.capture("detect"):
+        with profiling.record("decode"):
+            image = decode_image(file_content)
+        with profiling.record("transform"):
+            tensor = image_transform(image).unsqueeze(0)
+        detector = model_manager.get()
+        with profiling.record("model"):
+            label, confidence, stage = detector.detect(tensor)
+    return tensor, detector.version, label, confidence, stage
+
+
+def store_upload(filename, file_content, user_id, label, confidence, image_hash, duplicate_of, model_version) -> str:
+    image_id = dynamo.images_insert(
+        filename, "", user_id, label, confidence, phash.to_hex(image_hash), duplicate_of, model_version
+    ).get("id")
+    s3_key = s3.put_image_to_s3(filename, image_id, file_content)
+    dynamo.images_update_s3_key(image_id, s3_key)
+    phash.index.add(image_hash, {
+        "id": image_id, "prediction": label, "confidence": confidence,
+        "duplicate_of": duplicate_of, "model_version": model_version,
+    })
+    return image_id
+
+
+async def run_shadow(tensor, label: str):
+    # Shadow inference only uses spare capacity, so it never competes with queued requests.
+    if not admission.controller.try_acquire():
+        return
+    try:
+        await run_in_threadpool(model_manager.score_shadow, tensor, label)
+    finally:
+        admission.controller.release()
+
+
+def can_reuse(duplicate: dict | None) -> bool:
+    # Predictions from an older model are stale once a new one is served, so only reuse
+    # matches scored by the current model version.
+    return bool(duplicate) and phash.PHASH_REUSE and duplicate["model_version"] == model_manager.get().version
+
+
 @app.get("/detect")
 async def detect_page(user=Depends(browser_auth)):
     return FileResponse(os.path.join(directory_path, "index.html"))
 
 
 @app.post("/detect", response_model=DetectionResponse)
-async def detect_image(request: Request, user=Depends(authenticate_token), file: UploadFile = File(...)):
+async def detect_image(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    user=Depends(authenticate_token),
+    file: UploadFile = File(...),
+):
     try:
         if not file:
             raise HTTPException(status_code=401, detail="No image file attached")
@@ -125,24 +185,37 @@ async def detect_image(request: Request, user=Depends(authenticate_token), file:
         if len(file_content) > 10 * 1024 * 1024:
             raise HTTPException(status_code=400, detail="File too large (max 10MB).")
 
-        tensor = preprocess_image(file_content)
-        label, confidence = detector.predict(tensor)
-
-        image_id = dynamo.images_insert(file.filename, "", user["id"], label, confidence).get("id")
-        s3_key = s3.put_image_to_s3(file.filename, image_id, file_content)
-        dynamo.images_update_s3_key(image_id, s3_key)
+        admission.controller.check(user["id"], admission.HIGH)
+        image_hash, duplicate = await run_in_threadpool(phash.find_duplicate, file_content, model_manager.get().version)
+        if can_reuse(duplicate):
+            label, confidence, stage = duplicate["prediction"], float(duplicate["confidence"]), "duplicate"
+            model_version = duplicate["model_version"]
+        else:
+            async with admission.controller.slot(request, user["id"], admission.HIGH):
+                tensor, model_version, label, confidence, stage = await run_in_threadpool(run_detection, file_content)
+            if model_manager.should_shadow():
+                background_tasks.add_task(run_shadow, tensor, label)
+
+        duplicate_of = duplicate["id"] if duplicate else None
+        image_id = await run_in_threadpool(
+            store_upload, file.filename, file_content, user["id"], label, confidence,
+            image_hash, duplicate_of, model_version,
+        )
+        background_tasks.add_task(generate_previews, image_id, file_content)
 
         referer = request.headers.get("Referer", "")
         main_page_url = request.url_for("main_page")
         if referer.startswith(str(main_page_url)):
             return RedirectResponse(url=f"/result/{image_id}", status_code=303)
-        return DetectionResponse(prediction=label, confidence=confidence)
+        return DetectionResponse(prediction=label, confidence=confidence, stage=stage, model_version=model_version)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/detect-image", response_model=DetectionResponse)
-async def detect_image_simple(request: Request, file: UploadFile = File(...)):
+async def detect_image_simple(request: Request, background_tasks: BackgroundTasks, file: UploadFile = File(...)):
     try:
         if not file:
             raise HTTPException(status_code=401, detail="No image file attached")
@@ -153,9 +226,25 @@ async def detect_image_simple(request: Request, file: UploadFile = File(...)):
         if len(file_content) > 10 * 1024 * 1024:
             raise HTTPException(status_code=400, detail="File too large (max 10MB).")
 
-        tensor = preprocess_image(file_content)
-        label, confidence = detector.predict(tensor)
-        return DetectionResponse(prediction=label, confidence=confidence)
+        client = request.client.host if request.client else "anonymous"
+        user_key = f"ip:{client}"
+        admission.controller.check(user_key, admission.LOW)
+        duplicate = None
+        if phash.PHASH_REUSE:
+            _, duplicate = await run_in_threadpool(phash.find_duplicate, file_content, model_manager.get().version)
+        if can_reuse(duplicate):
+            return DetectionResponse(
+                prediction=duplicate["prediction"], confidence=float(duplicate["confidence"]),
+                stage="duplicate", model_version=duplicate["model_version"],
+            )
+
+        async with admission.controller.slot(request, user_key, admission.LOW):
+            tensor, model_version, label, confidence, stage = await run_in_threadpool(run_detection, file_content)
+        if model_manager.should_shadow():
+            background_tasks.add_task(run_shadow, tensor, label)
+        return DetectionResponse(prediction=label, confidence=confidence, stage=stage, model_version=model_version)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -173,12 +262,14 @@ async def result_page(image_id: str, request: Request, user=Depends(browser_auth
     presigned_url = s3.get_image_from_s3_presigned_url(s3_key)
     if not presigned_url:
         raise HTTPException(status_code=404, detail="Image not found")
+    preview_url = s3.get_image_from_s3_presigned_url(image_data.get("medium_key")) or presigned_url
     return templates.TemplateResponse(
         "result.html",
         {
             "request": request,
             "image_id": image_id,
             "image_url": presigned_url,
+            "preview_url": preview_url,
             "prediction": image_data["prediction"],
             "confidence": image_data["confidence"],
             "user_prediction": image_data.get("user_prediction"),
@@ -224,11 +315,125 @@ async def admin_uploads(
     images = dynamo.images_list(limit, offset, sort_by, order, username, prediction)
     for img in images:
         img["image_url"] = s3.get_image_from_s3_presigned_url(img["s3_key"])
+        img["thumbnail_url"] = s3.get_image_from_s3_presigned_url(img.get("thumbnail_key")) or img["image_url"]
         uid = img.get("user_id")
         img["username"] = dynamo.users_get_username_by_id(uid) if uid else None
     return images
 
 
+EXPORT_FIELDS = [
+    "id", "filename", "user_id", "username", "prediction", "confidence",
+    "user_prediction", "duplicate_of", "uploaded_at", "s3_key",
+]
+
+
+def _export_records(username: str | None, prediction: str | None, include_urls: bool):
+    usernames = {}
+    for img in dynamo.images_iter(username, prediction):
+        uid = img.get("user_id")
+        if uid and uid not in usernames:
+            usernames[uid] = dynamo.users_get_username_by_id(uid)
+        record = {field: img.get(field) for field in EXPORT_FIELDS}
+        record["username"] = usernames.get(uid)
+        if record["confidence"] is not None:
+            record["confidence"] = float(record["confidence"])
+        if include_urls:
+            record["image_url"] = s3.get_image_from_s3_presigned_url(img.get("s3_key"))
+        yield record
+
+
+def _csv_safe(value):
+    # Filenames are user-controlled; keep spreadsheets from evaluating them as formulas.
+    if isinstance(value, str) and value.startswith(("=", "+", "-", "@", "\t", "\r")):
+        return "'" + value
+    return value
+
+
+def _export_csv(records, fields):
+    buf = StringIO()
+    writer = csv.DictWriter(buf, fieldnames=fields)
+    writer.writeheader()
+    for record in records:
+        writer.writerow({k: _csv_safe(v) for k, v in record.items()})
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+def _export_ndjson(records):
+    for record in records:
+        yield json.dumps(record) + "\n"
+
+
+@app.get("/admin/uploads/export")
+async def admin_uploads_export(
+    user=Depends(admin_auth),
+    format: str = Query("csv", regex="^(csv|ndjson)$"),
+    username: str | None = None,
+    prediction: str | None = None,
+    include_urls: bool = False,
+):
+    records = _export_records(username, prediction, include_urls)
+    if format == "ndjson":
+        body, media_type = _export_ndjson(records), "application/x-ndjson"
+    else:
+        fields = EXPORT_FIELDS + (["image_url"] if include_urls else [])
+        body, media_type = _export_csv(records, fields), "text/csv"
+    filename = f"uploads.{format}"
+    return StreamingResponse(body, media_type=media_type, headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+
+@app.get("/admin/model")
+async def admin_model(user=Depends(admin_auth)):
+    return {"pid": os.getpid(), **model_manager.status()}
+
+
+@app.post("/admin/model/reload")
+async def admin_model_reload(user=Depends(admin_auth), model_key: str = MODEL_KEY, shadow: bool = False):
+    if not model_manager.reload_in_background(model_key, shadow):
+        raise HTTPException(status_code=409, detail="A model reload is already in progress")
+    return {"status": "loading", "model_key": model_key, "shadow": shadow, "pid": os.getpid()}
+
+
+@app.post("/admin/model/promote")
+async def admin_model_promote(user=Depends(admin_auth)):
+    if not model_manager.promote():
+        raise HTTPException(status_code=404, detail="No candidate model loaded")
+    return {"status": "promoted", **model_manager.status()}
+
+
+@app.post("/admin/profile")
+async def admin_profile(
+    user=Depends(admin_auth),
+    requests: int = Query(0, ge=0, le=1000),
+    seconds: float = Query(0, ge=0, le=300),
+):
+    session = profiling.start(requests, seconds)
+    if session is None:
+        raise HTTPException(status_code=409, detail="A profile capture is already running")
+    return {"status": "capturing", "pid": os.getpid(), **session.status()}
+
+
+@app.get("/admin/profile")
+async def admin_profile_status(user=Depends(admin_auth)):
+    return profiling.status()
+
+
+@app.get("/admin/metrics")
+async def admin_metrics(user=Depends(admin_auth)):
+    detector = model_manager.get()
+    return {
+        "pid": os.getpid(),
+        "memory": memory_usage(),
+        "cascade": detector.stats() if isinstance(detector, CascadeDetector) else None,
+        "admission": admission.controller.stats(),
+        "phash_index_loaded": phash.index.loaded,
+        # Per-worker index: other workers' uploads are only matched after the next refresh.
+        "phash_index_refreshed_at": phash.index.refreshed_at,
+    }
+
+
 @app.get("/game/image")
 def get_game_image(user=Depends(browser_auth)):
     sources = [("https://thispersondoesnotexist.com", "ai"), ("https://randomuser.me/api/?inc=picture", "real")]
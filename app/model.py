@@ -1,27 +1,256 @@
+import os
+import random
+import threading
+import time
+
 import torch
 import torch.nn as nn
-from aws_related.s3 import load_model
+import torch.nn.functional as F
+from aws_related.s3 import load_model, resolve_model, get_model_version, MODEL_KEY, MODEL_CACHE_DIR
 from torchvision import models
+from utils import memory_usage
+
+CASCADE_ENABLED = os.getenv("CASCADE_ENABLED", "0") == "1"
+CASCADE_THRESHOLD = float(os.getenv("CASCADE_THRESHOLD", "0.9"))
+FAST_MODEL_ARCH = os.getenv("FAST_MODEL_ARCH", "resnet18")
+FAST_MODEL_KEY = os.getenv("AWS_S3_FAST_MODEL_KEY", "model/model_fast.pth")
+FAST_MODEL_INPUT_SIZE = int(os.getenv("FAST_MODEL_INPUT_SIZE", "224"))
+MODEL_POLL_SECONDS = int(os.getenv("MODEL_POLL_SECONDS", "0"))
+SHADOW_SAMPLE_RATE = float(os.getenv("SHADOW_SAMPLE_RATE", "0.1"))
+
+# Split the cores between uvicorn workers instead of letting each one spawn a thread per core.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+# The affinity mask honours cpusets and taskset, unlike os.cpu_count().
+AVAILABLE_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", "0")) or max(1, AVAILABLE_CPUS // WEB_CONCURRENCY)
+
+torch.set_num_threads(TORCH_NUM_THREADS)
+try:
+    torch.set_num_interop_threads(1)
+except RuntimeError:
+    pass
+
+def _replace_head(model, arch: str):
+    # ResNets end in .fc; MobileNet, EfficientNet and VGG end in a .classifier Sequential.
+    if isinstance(getattr(model, "fc", None), nn.Linear):
+        model.fc = nn.Linear(model.fc.in_features, 2)
+    elif isinstance(getattr(model, "classifier", None), nn.Sequential) and isinstance(model.classifier[-1], nn.Linear):
+        model.classifier[-1] = nn.Linear(model.classifier[-1].in_features, 2)
+    else:
+        raise ValueError(f"Unsupported architecture {arch}: expected a Linear .fc or .classifier head")
 
 class AIImageDetector:
-    def __init__(self, model_path: str = None):
+    def __init__(self, model_path: str = None, arch: str = "resnet50", model_key: str = MODEL_KEY,
+                 input_size: int | None = None, stage: str = "full"):
         self.device = torch.device("cpu")
-        self.model = models.resnet50(weights=True)
-        self.model.fc = nn.Linear(self.model.fc.in_features, 2)
-        if model_path:
-            if model_path == "image":
-                self.model.load_state_dict(load_model())
+        self.stage = stage
+        self.input_size = input_size
+        load_weights = model_path == "image"
+        ref = resolve_model(model_key) if load_weights else None
+        self.version = ref["version"] if ref else None
+        # Pretrained weights would be overwritten by the state dict anyway, so skip downloading them.
+        if not hasattr(models, arch):
+            raise ValueError(f"Unknown torchvision architecture: {arch}")
+        self.model = getattr(models, arch)(weights=None if load_weights else True)
+        _replace_head(self.model, arch)
+        if load_weights:
+            # assign=True keeps the (possibly memory-mapped) tensors instead of copying into fresh ones.
+            self.model.load_state_dict(load_model(ref), assign=bool(MODEL_CACHE_DIR))
         self.model.eval()
 
     def predict(self, tensor):
+        label, confidence, _ = self.detect(tensor)
+        return label, confidence
+
+    def detect(self, tensor):
+        label, confidence = self.predict_batch(tensor)[0]
+        return label, confidence, self.stage
+
+    def predict_batch(self, batch):
         with torch.no_grad():
-            batch = tensor.repeat(8, 1, 1, 1)
+            if self.input_size and batch.shape[-1] != self.input_size:
+                batch = F.interpolate(batch, size=(self.input_size, self.input_size), mode="bilinear", align_corners=False)
             outputs = self.model(batch)
             probs = torch.softmax(outputs, dim=1)
             confidences, predicted_classes = torch.max(probs, dim=1)
-            predicted_class = predicted_classes[0]
-            confidence = confidences[0]
-            label = "AI-generated" if predicted_class.item() == 1 else "Real"
-            return label, confidence.item()
+            labels = ["AI-generated" if c == 1 else "Real" for c in predicted_classes.tolist()]
+            return list(zip(labels, confidences.tolist()))
+
+class CascadeDetector:
+    def __init__(self, fast: AIImageDetector, full: AIImageDetector, threshold: float = CASCADE_THRESHOLD):
+        self.fast = fast
+        self.full = full
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._escalated = 0
+        self._seconds = {fast.stage: 0.0, full.stage: 0.0}
+
+    @property
+    def version(self):
+        # Both stages can answer, so a change to either model must change the version.
+        return f"{self.full.version}+{self.fast.version}"
+
+    def predict(self, tensor):
+        label, confidence, _ = self.detect(tensor)
+        return label, confidence
+
+    def detect(self, tensor):
+        start = time.perf_counter()
+        label, confidence, stage = self.fast.detect(tensor)
+        fast_done = time.perf_counter()
+        escalate = confidence < self.threshold
+        if escalate:
+            label, confidence, stage = self.full.detect(tensor)
+        with self._lock:
+            self._requests += 1
+            self._escalated += escalate
+            self._seconds[self.fast.stage] += fast_done - start
+            if escalate:
+                self._seconds[self.full.stage] += time.perf_counter() - fast_done
+        return label, confidence, stage
+
+    def stats(self):
+        with self._lock:
+            requests, escalated = self._requests, self._escalated
+            seconds = dict(self._seconds)
+        return {
+            "threshold": self.threshold,
+            "requests": requests,
+            "escalated": escalated,
+            "escalation_rate": escalated / requests if requests else 0.0,
+            "avg_fast_seconds": seconds[self.fast.stage] / requests if requests else 0.0,
+            "avg_full_seconds": seconds[self.full.stage] / escalated if escalated else 0.0,
+        }
+
+def build_detector(model_key: str = MODEL_KEY, fast: AIImageDetector | None = None):
+    full = AIImageDetector(model_path="image", model_key=model_key)
+    if not CASCADE_ENABLED:
+        return full
+    if fast is None:
+        try:
+            fast = AIImageDetector(model_path="image", arch=FAST_MODEL_ARCH, model_key=FAST_MODEL_KEY,
+                                   input_size=FAST_MODEL_INPUT_SIZE, stage="fast")
+        except Exception as e:
+            print(f"[warn] cascade disabled, fast model failed to load: {e}")
+            return full
+    return CascadeDetector(fast, full)
+
+def _warm_up(detector):
+    # Run every stage once so the first real request does not pay for lazy allocations.
+    dummy = torch.zeros(1, 3, 448, 448)
+    for stage in (getattr(detector, "fast", None), getattr(detector, "full", detector)):
+        if stage is not None:
+            stage.detect(dummy)
+
+class ModelManager:
+    # Holds the serving detector. Swaps are a single attribute assignment, so a request that
+    # already fetched the old detector finishes on it while new requests get the new one.
+    def __init__(self):
+        self._current = None
+        self._candidate = None
+        self._lock = threading.Lock()
+        self._loading = threading.Lock()
+        self._shadow_lock = threading.Lock()
+        self._shadow = {"samples": 0, "agreements": 0}
+        self.last_error = None
+
+    def get(self):
+        if self._current is None:
+            with self._lock:
+                if self._current is None:
+                    self._current = build_detector()
+                    print(f"[info] worker {os.getpid()} loaded model {self._current.version} with "
+                          f"{TORCH_NUM_THREADS} torch threads, memory: {memory_usage()}")
+        return self._current
+
+    @property
+    def candidate(self):
+        return self._candidate
+
+    def reload(self, model_key: str = MODEL_KEY, shadow: bool = False):
+        if not self._loading.acquire(blocking=False):
+            return False
+        self._reload(model_key, shadow)
+        return True
+
+    def _reload(self, model_key: str, shadow: bool):
+        # Called with self._loading held; releases it when done.
+        try:
+            current = self.get()
+            fast = current.fast if isinstance(current, CascadeDetector) else None
+            if fast is not None and fast.version != get_model_version(FAST_MODEL_KEY):
+                fast = None
+            detector = build_detector(model_key, fast=fast)
+            _warm_up(detector)
+            if shadow:
+                with self._shadow_lock:
+                    self._shadow = {"samples": 0, "agreements": 0}
+                self._candidate = detector
+            else:
+                self._current = detector
+            self.last_error = None
+            print(f"[info] worker {os.getpid()} loaded {'shadow' if shadow else 'serving'} model {detector.version}")
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"[warn] model reload failed: {e}")
+        finally:
+            self._loading.release()
+
+    def reload_in_background(self, model_key: str = MODEL_KEY, shadow: bool = False) -> bool:
+        # Take the lock here, so two concurrent calls cannot both report "loading".
+        if not self._loading.acquire(blocking=False):
+            return False
+        threading.Thread(target=self._reload, args=(model_key, shadow), daemon=True).start()
+        return True
+
+    def promote(self) -> bool:
+        candidate, self._candidate = self._candidate, None
+        if candidate is None:
+            return False
+        self._current = candidate
+        return True
+
+    def should_shadow(self) -> bool:
+        return self._candidate is not None and random.random() < SHADOW_SAMPLE_RATE
+
+    def score_shadow(self, tensor, label: str):
+        candidate = self._candidate
+        if candidate is None:
+            return
+        shadow_label, _, _ = candidate.detect(tensor)
+        with self._shadow_lock:
+            self._shadow["samples"] += 1
+            self._shadow["agreements"] += shadow_label == label
+
+    def start_polling(self, interval: int = MODEL_POLL_SECONDS):
+        def poll():
+            while True:
+                time.sleep(interval)
+                try:
+                    current = self.get()
+                    stages = [getattr(current, "full", current)]
+                    if isinstance(current, CascadeDetector):
+                        stages.append(current.fast)
+                    model_key = stages[0].version.rsplit("@", 1)[0]
+                    if any(get_model_version(s.version.rsplit("@", 1)[0]) != s.version for s in stages):
+                        self.reload(model_key)
+                except Exception as e:
+                    print(f"[warn] model poll failed: {e}")
+
+        if interval > 0:
+            threading.Thread(target=poll, daemon=True).start()
+
+    def status(self):
+        with self._shadow_lock:
+            shadow = dict(self._shadow)
+        shadow["agreement_rate"] = shadow["agreements"] / shadow["samples"] if shadow["samples"] else None
+        return {
+            "version": self._current.version if self._current else None,
+            "candidate_version": self._candidate.version if self._candidate else None,
+            "loading": self._loading.locked(),
+            "last_error": self.last_error,
+            "shadow": shadow,
+        }
 
-detector = AIImageDetector(model_path="image")
\ No newline at end of file
+manager = ModelManager()
@@ -0,0 +1,198 @@
+import io
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from PIL import Image
+
+from app.aws_related import dynamo
+
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "6"))
+PHASH_REUSE = os.getenv("PHASH_REUSE", "1") == "1"
+PHASH_LOAD_RETRY_SECONDS = float(os.getenv("PHASH_LOAD_RETRY_SECONDS", "30"))
+PHASH_REFRESH_SECONDS = float(os.getenv("PHASH_REFRESH_SECONDS", "60"))
+PHASH_REFRESH_OVERLAP_SECONDS = 60
+
+
+def dhash(image_bytes: bytes, size: int = 8) -> int:
+    # Difference hash: compares neighbouring pixels of a tiny greyscale copy,
+    # so it survives resizing and recompression.
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft("L", (size * 4, size * 4))
+    pixels = list(image.convert("L").resize((size + 1, size), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def to_hex(value: int) -> str:
+    return f"{value:016x}"
+
+
+def from_hex(value: str) -> int:
+    return int(value, 16)
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, value: int, item):
+        node = [value, item, {}]
+        self._size += 1
+        if self._root is None:
+            self._root = node
+            return
+        current = self._root
+        while True:
+            dist = hamming(value, current[0])
+            child = current[2].get(dist)
+            if child is None:
+                current[2][dist] = node
+                return
+            current = child
+
+    def search(self, value: int, max_distance: int):
+        # Triangle inequality: only children whose edge distance lies within
+        # [d - max_distance, d + max_distance] can contain matches.
+        if self._root is None:
+            return []
+        found, stack = [], [self._root]
+        while stack:
+            node = stack.pop()
+            dist = hamming(value, node[0])
+            if dist <= max_distance:
+                found.append((dist, node[1]))
+            for edge, child in node[2].items():
+                if dist - max_distance <= edge <= dist + max_distance:
+                    stack.append(child)
+        found.sort(key=lambda x: x[0])
+        return found
+
+
+class NearDuplicateIndex:
+    # Each worker keeps its own tree, so uploads handled by other workers only show up
+    # after the next refresh (PHASH_REFRESH_SECONDS).
+    def __init__(self, max_distance: int = PHASH_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self._tree = BKTree()
+        # Entries by image id, so a refresh updates re-scored items instead of adding them twice.
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._refreshed_at = None
+        # Uploads indexed while the table scan runs, replayed into the scanned tree.
+        self._pending = []
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    @property
+    def refreshed_at(self) -> str | None:
+        return self._refreshed_at
+
+    def load(self):
+        started = _now_iso()
+        tree, entries = BKTree(), {}
+        for item in dynamo.images_iter():
+            if item.get("phash"):
+                entries[item["id"]] = _entry(item)
+                tree.add(from_hex(item["phash"]), entries[item["id"]])
+        with self._lock:
+            for value, image_id, entry in self._pending:
+                if image_id not in entries:
+                    entries[image_id] = entry
+                    tree.add(value, entry)
+            self._tree, self._entries = tree, entries
+            self._pending = []
+            self._loaded = True
+            self._refreshed_at = started
+
+    def refresh(self):
+        # Picks up items uploaded or re-scored since the last scan. The overlap covers clock
+        # skew between workers; items already indexed are updated in place.
+        started = _now_iso()
+        since = datetime.fromisoformat(self._refreshed_at) - timedelta(seconds=PHASH_REFRESH_OVERLAP_SECONDS)
+        for item in dynamo.images_iter(changed_since=since.isoformat()):
+            if item.get("phash"):
+                self._add(from_hex(item["phash"]), item)
+        self._refreshed_at = started
+
+    def load_in_background(self, retry_seconds: float = PHASH_LOAD_RETRY_SECONDS,
+                           refresh_seconds: float = PHASH_REFRESH_SECONDS):
+        # Lookups answer from whatever is indexed so far and never wait for the scan.
+        def run():
+            while not self._loaded:
+                try:
+                    self.load()
+                except Exception as e:
+                    print(f"[warn] phash index load failed, retrying in {retry_seconds}s: {e}")
+                    time.sleep(retry_seconds)
+            while refresh_seconds > 0:
+                time.sleep(refresh_seconds)
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"[warn] phash index refresh failed: {e}")
+
+        threading.Thread(target=run, name="phash-index-load", daemon=True).start()
+
+    def add(self, value: int, item: dict):
+        self._add(value, item)
+
+    def _add(self, value: int, item: dict):
+        entry = _entry(item)
+        with self._lock:
+            existing = self._entries.get(item["id"])
+            if existing is not None:
+                existing.update(entry)
+                return
+            self._entries[item["id"]] = entry
+            self._tree.add(value, entry)
+            if not self._loaded:
+                self._pending.append((value, item["id"], entry))
+
+    def find(self, value: int, max_distance: int | None = None, model_version: str | None = None):
+        # Prefers the closest match scored by model_version, falling back to the closest overall.
+        limit = self.max_distance if max_distance is None else max_distance
+        with self._lock:
+            matches = [(dist, dict(item)) for dist, item in self._tree.search(value, limit)]
+        if not matches:
+            return None
+        dist, item = min(matches, key=lambda m: (m[1].get("model_version") != model_version, m[0]))
+        return {**item, "distance": dist}
+
+
+def _entry(item: dict) -> dict:
+    return {
+        "id": item.get("duplicate_of") or item["id"],
+        "prediction": item.get("prediction"),
+        "confidence": item.get("confidence"),
+        "model_version": item.get("model_version"),
+    }
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def find_duplicate(image_bytes: bytes, model_version: str | None = None):
+    value = dhash(image_bytes)
+    return value, index.find(value, model_version=model_version)
+
+
+index = NearDuplicateIndex()
@@ -0,0 +1,211 @@
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from torch.profiler import ProfilerActivity, profile, record_function
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "profiles"))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_DEFAULT_SECONDS = 10.0
+PROFILE_MAX_SECONDS = 300.0
+
+_session = None
+_last = None
+_start_lock = threading.Lock()
+
+
+def _now_us() -> int:
+    return time.time_ns() // 1000
+
+
+class _Sampler(threading.Thread):
+    # Samples every Python thread's stack and turns runs of identical frames into
+    # Chrome-trace "complete" events, which render as a flame chart per thread.
+    def __init__(self, interval: float):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.interval = interval
+        self.events = []
+        self._open = {}
+        self._halt = threading.Event()
+
+    def run(self):
+        # Threads are keyed by native id, which is what torch.profiler puts in "tid",
+        # so a worker thread's Python stacks and torch ops share one row.
+        names = {}
+        while not self._halt.wait(self.interval):
+            now = _now_us()
+            threads = {t.ident: t for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                thread = threads.get(ident)
+                if ident == self.ident or thread is None or thread.native_id is None:
+                    continue
+                names[thread.native_id] = thread.name
+                self._update(thread.native_id, self._stack(frame), now)
+        now = _now_us()
+        for tid in list(self._open):
+            self._update(tid, [], now)
+        for tid in {e["tid"] for e in self.events}:
+            self.events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                                "args": {"name": f"python: {names.get(tid, tid)}"}})
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+
+    @staticmethod
+    def _stack(frame) -> list:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        stack.reverse()
+        return stack
+
+    def _update(self, tid: int, stack: list, now: int):
+        opened = self._open.setdefault(tid, [])
+        common = 0
+        while common < len(opened) and common < len(stack) and opened[common][0] == stack[common]:
+            common += 1
+        for name, start in opened[common:]:
+            self.events.append({"name": name, "cat": "python", "ph": "X", "ts": start,
+                                "dur": max(now - start, 1), "pid": os.getpid(), "tid": tid})
+        del opened[common:]
+        opened.extend([name, now] for name in stack[common:])
+
+
+class ProfileSession:
+    def __init__(self, requests: int, seconds: float):
+        self.requests = requests
+        # A request-count capture still gets a time cap, so a quiet worker does not sample forever.
+        self.seconds = min(seconds or (PROFILE_MAX_SECONDS if requests else PROFILE_DEFAULT_SECONDS), PROFILE_MAX_SECONDS)
+        self.captured = 0
+        self.path = os.path.join(PROFILE_DIR, f"profile-{os.getpid()}-{int(time.time())}.json")
+        self._events = []
+        self._lock = threading.Lock()
+        # torch.profiler only supports one active profiler, so concurrent requests are skipped.
+        self._torch_lock = threading.Lock()
+        self._finished = False
+        self._sampler = _Sampler(PROFILE_SAMPLE_INTERVAL)
+        self._timer = threading.Timer(self.seconds, self.finish)
+        self._timer.daemon = True
+        # Exporting a trace writes and re-parses a JSON file, so it runs here instead of on the
+        # profiled request, which may still hold an admission slot.
+        self._pending = queue.Queue()
+        self._exporter = threading.Thread(target=self._export_pending, name="profile-export", daemon=True)
+
+    def start(self):
+        self._sampler.start()
+        self._exporter.start()
+        self._timer.start()
+
+    @contextmanager
+    def capture(self, name: str):
+        # Profiler failures are logged and never reach the request being profiled.
+        if not self._torch_lock.acquire(blocking=False):
+            yield
+            return
+        prof = None
+        try:
+            try:
+                prof = profile(activities=[ProfilerActivity.CPU], record_shapes=True)
+                prof.start()
+            except Exception as e:
+                print(f"[warn] profiler failed to start: {e}")
+                prof = None
+            with record_function(name) if prof else nullcontext():
+                yield
+        finally:
+            if prof:
+                try:
+                    prof.stop()
+                except Exception as e:
+                    print(f"[warn] profiler failed to stop: {e}")
+                    prof = None
+            self._torch_lock.release()
+        if prof:
+            self._pending.put(prof)
+            with self._lock:
+                self.captured += 1
+                done = self.requests and self.captured >= self.requests
+            if done:
+                threading.Thread(target=self.finish, daemon=True).start()
+
+    def _export_pending(self):
+        while True:
+            prof = self._pending.get()
+            if prof is None:
+                return
+            self._collect(prof)
+
+    def _collect(self, prof):
+        try:
+            with tempfile.NamedTemporaryFile(suffix=".json") as tmp:
+                prof.export_chrome_trace(tmp.name)
+                with open(tmp.name) as f:
+                    trace = json.load(f)
+        except Exception as e:
+            print(f"[warn] could not export profiler trace: {e}")
+            return
+        # torch writes "ts" relative to baseTimeNanoseconds; make it absolute like the sampler's.
+        base_us = trace.get("baseTimeNanoseconds", 0) / 1000
+        events = trace.get("traceEvents", [])
+        for event in events:
+            if "ts" in event:
+                event["ts"] = float(event["ts"]) + base_us
+        self._events.extend(events)
+
+    def finish(self):
+        global _session, _last
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        self._timer.cancel()
+        self._sampler.stop()
+        self._pending.put(None)
+        self._exporter.join()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": self._events + self._sampler.events, "displayTimeUnit": "ms"}, f)
+        print(f"[info] profile written to {self.path}")
+        _last = self.status()
+        _session = None
+
+    def status(self):
+        return {
+            "path": self.path,
+            "requests": self.requests,
+            "seconds": self.seconds,
+            "captured": self.captured,
+            "finished": self._finished,
+        }
+
+
+def start(requests: int = 0, seconds: float = 0):
+    global _session
+    with _start_lock:
+        if _session is not None:
+            return None
+        _session = ProfileSession(requests, seconds)
+        _session.start()
+        return _session
+
+
+def status():
+    return {"pid": os.getpid(), "active": _session.status() if _session else None, "last": _last}
+
+
+def capture(name: str = "request"):
+    # A single global check keeps the inference path free of profiler overhead when idle.
+    session = _session
+    return session.capture(name) if session is not None else nullcontext()
+
+
+def record(name: str):
+    return record_function(name) if _session is not None else nullcontext()
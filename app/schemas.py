@@ -3,3 +3,5 @@ from pydantic import BaseModel
 class DetectionResponse(BaseModel):
     prediction: str
     confidence: float
+    stage: str | None = None
+    model_version: str | None = None
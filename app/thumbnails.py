@@ -0,0 +1,66 @@
+import argparse
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+from app.aws_related import dynamo, s3
+
+# Largest side in pixels, biggest first so each preview is resized from the previous one.
+PREVIEW_SIZES = {"medium": 1024, "thumbnail": 256}
+
+
+def make_previews(image_bytes: bytes) -> dict:
+    image = Image.open(io.BytesIO(image_bytes))
+    largest = max(PREVIEW_SIZES.values())
+    image.draft("RGB", (largest, largest))
+    # Previews are saved without EXIF, so bake the orientation in or phone photos show up sideways.
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    previews = {}
+    for size_name, max_side in PREVIEW_SIZES.items():
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        buf = io.BytesIO()
+        image.save(buf, format="JPEG", quality=85, optimize=True)
+        previews[size_name] = buf.getvalue()
+    return previews
+
+
+def generate_previews(image_id: str, image_bytes: bytes):
+    try:
+        previews = make_previews(image_bytes)
+        keys = {name: s3.put_preview_to_s3(image_id, name, data) for name, data in previews.items()}
+        dynamo.images_update_preview_keys(image_id, keys["thumbnail"], keys["medium"])
+    except Exception as e:
+        print(f"[warn] preview generation failed for {image_id}: {e}")
+
+
+def _backfill_one(item: dict):
+    try:
+        data = s3.get_object_bytes(item["s3_key"])
+    except Exception as e:
+        print(f"[warn] could not fetch {item['s3_key']}: {e}")
+        return
+    generate_previews(item["id"], data)
+
+
+def backfill(force: bool = False, workers: int = 4):
+    pending = (
+        item for item in dynamo.images_iter()
+        if item.get("s3_key") and (force or not item.get("thumbnail_key"))
+    )
+    start, done = time.time(), 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(_backfill_one, pending):
+            done += 1
+            if done % 100 == 0:
+                print(f"{done} images processed")
+    print(f"Backfilled {done} images in {time.time() - start:.2f} seconds")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate thumbnail and medium previews for existing uploads.")
+    parser.add_argument("--force", action="store_true", help="regenerate previews that already exist")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    backfill(force=args.force, workers=args.workers)
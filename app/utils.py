@@ -2,14 +2,32 @@ from PIL import Image
 import io
 from torchvision import transforms
 
+image_transform = transforms.Compose([
+    transforms.Resize((448, 448)),
+    transforms.RandomRotation(20),
+    transforms.ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0.1),
+    transforms.ToTensor(),
+    transforms.Normalize([0.485, 0.456, 0.406],
+                        [0.229, 0.224, 0.225])
+])
+
+def decode_image(image_bytes: bytes):
+    return Image.open(io.BytesIO(image_bytes)).convert("RGB")
+
 def preprocess_image(image_bytes: bytes):
-    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-    transform = transforms.Compose([
-        transforms.Resize((448, 448)),
-        transforms.RandomRotation(20),
-        transforms.ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0.1),
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406],
-                            [0.229, 0.224, 0.225])
-    ])
-    return transform(image).unsqueeze(0) 
+    return image_transform(decode_image(image_bytes)).unsqueeze(0)
+
+def memory_usage() -> dict:
+    # Resident memory of this process in MB, split into private (anon) and file-backed pages;
+    # mmapped model weights show up under rss_file and are shared between workers.
+    fields = {"VmRSS": "rss_mb", "RssAnon": "rss_anon_mb", "RssFile": "rss_file_mb", "RssShmem": "rss_shmem_mb"}
+    usage = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in fields:
+                    usage[fields[name]] = round(int(value.split()[0]) / 1024, 1)
+    except OSError:
+        pass
+    return usage
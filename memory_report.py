@@ -0,0 +1,31 @@
+import sys
+import requests
+
+URL = "http://localhost:8080"
+USERNAME = "admin"
+PASSWORD = "password"
+MAX_POLLS = 500         # give up if some workers never answer
+
+def collect(base_url, expected):
+    session = requests.Session()
+    resp = session.post(f"{base_url}/login", json={"username": USERNAME, "password": PASSWORD}, timeout=10)
+    resp.raise_for_status()
+    workers = {}
+    for _ in range(MAX_POLLS):
+        metrics = session.get(f"{base_url}/admin/metrics", timeout=10).json()
+        workers[metrics["pid"]] = metrics["memory"]
+        if len(workers) >= expected:
+            break
+    return workers
+
+if __name__ == "__main__":
+    base_url = sys.argv[1] if len(sys.argv) > 1 else URL
+    expected = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    workers = collect(base_url, expected)
+    if len(workers) < expected:
+        print(f"[warn] only reached {len(workers)} of {expected} workers after {MAX_POLLS} polls")
+    print(f"{'pid':>8} {'rss_mb':>8} {'anon_mb':>8} {'file_mb':>8}")
+    for pid, memory in sorted(workers.items()):
+        print(f"{pid:>8} {memory.get('rss_mb', 0):>8} {memory.get('rss_anon_mb', 0):>8} {memory.get('rss_file_mb', 0):>8}")
+    total_anon = sum(m.get("rss_anon_mb", 0) for m in workers.values())
+    print(f"{len(workers)} workers, {total_anon:.1f} MB private (anon) memory in total")